@@ -48,10 +48,13 @@ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 import os
 import re
 import sys
+import time
 import shlex
 import subprocess
 from traceback import print_exc
+from functools import lru_cache
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 """
@@ -84,12 +87,31 @@ MOUNT_POINT = '/mnt/offsite-urbackup'
 # mount options for the btrfs filesystem
 MOUNT_OPTIONS = '-o compress-force=zstd:3'
 
+# seconds to wait for udev to link an unlocked filesystem by uuid
+UDEV_TIMEOUT = 10
+
 # program locations
 BTRFS = '/usr/bin/btrfs'
 MOUNT = '/usr/bin/mount'
 UMOUNT = '/usr/bin/umount'
 CRYPTSETUP = '/usr/sbin/cryptsetup'
 
+# mount command prefix, MOUNT_OPTIONS is only split once
+MOUNT_CMD = (MOUNT, *shlex.split(MOUNT_OPTIONS), '--uuid')
+
+# filesystem uuid found in "btrfs filesystem show" output (bytes)
+RE_FS_UUID = re.compile(rb'uuid: (?P<uuid>[-a-f0-9]+)')
+
+# BTRFS_DRIVES_MAP with the device paths computed once, format is:
+# {'btrfs uuid':(('luks uuid', 'mapper name', 'luks path', 'mapper path'), ...)}
+DRIVES_BY_BTRFS = {
+    btrfs_uuid: tuple(
+        (luks_uuid, dev_mapper,
+            f'/dev/disk/by-uuid/{luks_uuid}', f'/dev/mapper/{dev_mapper}')
+        for luks_uuid, dev_mapper in drives)
+    for btrfs_uuid, drives in BTRFS_DRIVES_MAP.items()
+    }
+
 
 ##
 ## function definitions
@@ -105,19 +127,95 @@ def parse_args():
     return parser.parse_args()
 
 
+def list_dir(path):
+    """
+    returns a set of the entry names in the passed directory
+    returns an empty set if the directory does not exist
+    """
+    try:
+        return {entry.name for entry in os.scandir(path)}
+    except FileNotFoundError:
+        return set()
+
+
+def get_mount_source(mount_point):
+    """
+    returns (source device, filesystem type) mounted at the passed
+    mount point, as listed in /proc/self/mountinfo
+    returns (None, None) if nothing is mounted there
+    mountinfo line example:
+      36 35 0:42 / /mnt/offsite-urbackup rw,relatime shared:1 - btrfs \
+      /dev/mapper/offsite-urbackup-a1 rw,compress-force=zstd:3
+    """
+    source, fs_type = None, None
+    with open('/proc/self/mountinfo') as f:
+        for line in f:
+            fields = line.split()
+            # mountinfo escapes spaces (etc.) in paths as octal, eg. '\040'
+            # (only those, other characters are left as they are)
+            path = re.sub(r'\\([0-7]{3})',
+                lambda m: chr(int(m.group(1), 8)), fields[4])
+            if path == mount_point:
+                # the last match is the one on top (mounts can be stacked)
+                sep = fields.index('-')
+                fs_type, source = fields[sep+1], fields[sep+2]
+    return source, fs_type
+
+
+@lru_cache(maxsize=4)
 def get_filesystem_uuid(mount_point):
     """
     returns the uuid of the passed btrfs mount point
     returns None if there was an error
+    the mounted device is matched to its btrfs filesystem via
+    /sys/fs/btrfs/<uuid>/devices/<device name>, without running btrfs
     """
+    source, fs_type = get_mount_source(mount_point)
+    if fs_type != 'btrfs':
+        return None
+
+    # eg. /dev/mapper/offsite-urbackup-a1 -> dm-0
+    dev_name = os.path.basename(os.path.realpath(source))
+    for uuid in list_dir('/sys/fs/btrfs'):
+        if os.path.exists(f'/sys/fs/btrfs/{uuid}/devices/{dev_name}'):
+            return uuid
+
+    # not found in sysfs, fall back to asking btrfs
     cmd = [BTRFS, 'filesystem', 'show', mount_point]
     try:
-        result = subprocess.run(cmd, check=True, capture_output=True, text=True)
-        re_pattern = r'uuid: (?P<uuid>[-a-f0-9]*)'
-        uuid = re.findall(re_pattern, result.stdout, re.MULTILINE)
-        return uuid[0]
-    except:
+        result = subprocess.run(cmd, check=True, capture_output=True)
+    except (subprocess.CalledProcessError, OSError):
         return None
+    match = RE_FS_UUID.search(result.stdout)
+    return match.group('uuid').decode() if match else None
+
+
+def wait_for_uuid(uuid, timeout):
+    """
+    wait for udev to create the /dev/disk/by-uuid link for uuid
+    returns True if it exists within timeout seconds
+    """
+    path = f'/dev/disk/by-uuid/{uuid}'
+    time_end = time.monotonic() + timeout
+    while not os.path.exists(path):
+        if time.monotonic() > time_end:
+            return False
+        time.sleep(0.1)
+    return True
+
+
+def unlock_drive(path_luks_uuid, dev_mapper, key):
+    """
+    open (unlock) a luks drive using cryptsetup
+    the key is passed on stdin, so the keyfile is only read once
+    raises CalledProcessError if cryptsetup fails
+    """
+    cmd_list = [CRYPTSETUP, 'open', path_luks_uuid, dev_mapper, '--key-file=-']
+    result = subprocess.run(cmd_list, input=key,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, cmd_list,
+            stderr=result.stderr.decode(errors='replace'))
 
 
 def mount():
@@ -140,84 +238,115 @@ def mount():
         print (f'Creating mountpoint {MOUNT_POINT}')
         os.mkdir(MOUNT_POINT)
 
-    # open (unlock) the drives using cryptsetup and the keyfile
-    mounted_drives = []
-    for btrfs_uuid in BTRFS_DRIVES_MAP:
+    # scan the device directories once, instead of probing each drive path
+    disk_uuids = list_dir('/dev/disk/by-uuid')
+    dev_mappers = list_dir('/dev/mapper')
+
+    # find the drives for each btrfs uuid, and which ones need unlocking
+    # found_drives format is {'btrfs uuid':[('mapper name', 'luks path'), ...]}
+    # listing only the found drives that are still locked
+    found_drives = {}
+    for btrfs_uuid, drives in DRIVES_BY_BTRFS.items():
         print (f'Trying to find drives for btrfs uuid {btrfs_uuid}')
-        found = False
-        for luks_uuid, dev_mapper in BTRFS_DRIVES_MAP[btrfs_uuid]:
-            path_luks_uuid = f'/dev/disk/by-uuid/{luks_uuid}'
-            path_dev_mapper = f'/dev/mapper/{dev_mapper}'
-            if os.path.exists(path_luks_uuid):
+        for luks_uuid, dev_mapper, path_luks_uuid, path_dev_mapper in drives:
+            if luks_uuid in disk_uuids:
                 print (f'  Found luks encrypted drive {path_luks_uuid}')
-                found = True
-                if os.path.exists(path_dev_mapper):
+                locked_drives = found_drives.setdefault(btrfs_uuid, [])
+                if dev_mapper in dev_mappers:
                     # drive is already unlocked
                     print (f'    drive is already unlocked at {path_dev_mapper}')
-                    if btrfs_uuid not in mounted_drives:
-                        mounted_drives.append(btrfs_uuid)
                 else:
-                    cmd = f'{CRYPTSETUP} open {path_luks_uuid} {dev_mapper} --key-file {KEYFILE}'
-                    cmd_list = shlex.split(cmd)
-                    result = subprocess.run(cmd_list, check=True, capture_output=True, text=True)
-                    if result.returncode == 0:
-                        print (f'    Successfully unlocked {path_luks_uuid}')
-                        if btrfs_uuid not in mounted_drives:
-                            mounted_drives.append(btrfs_uuid)
-                    else:
-                        print (result, file=sys.stderr)
-        if not found:
+                    locked_drives.append((dev_mapper, path_luks_uuid))
+        if btrfs_uuid not in found_drives:
             print (f'  No encrypted drives found for {btrfs_uuid}')
 
     # if there are no drives found, exit
-    if not mounted_drives:
+    if not found_drives:
         print ('No encrypted drives found, exiting', file=sys.stderr)
         sys.exit(1)
 
-    # mount the unlocked drives
-    for btrfs_uuid in mounted_drives:
-        cmd = f'{MOUNT} {MOUNT_OPTIONS} --uuid {btrfs_uuid} {MOUNT_POINT}'
-        cmd_list = shlex.split(cmd)
-        result = subprocess.run(cmd_list, check=True, capture_output=True, text=True)
-        if result.returncode == 0:
+    # read the keyfile once, it is shared by all the unlocks
+    num_locked = sum(len(locked) for locked in found_drives.values())
+    key = b''
+    if num_locked:
+        with open(KEYFILE, 'rb') as f:
+            key = f.read()
+
+    # open (unlock) the drives using cryptsetup and the keyfile
+    # each unlock is independent (and slow), so start them all at once,
+    # then mount each btrfs uuid as soon as its own drives are unlocked
+    with ThreadPoolExecutor(max_workers=max(num_locked, 1)) as executor:
+        unlocks = {}
+        for btrfs_uuid, locked_drives in found_drives.items():
+            unlocks[btrfs_uuid] = [
+                (executor.submit(unlock_drive, path_luks_uuid, dev_mapper, key),
+                    path_luks_uuid)
+                for dev_mapper, path_luks_uuid in locked_drives]
+
+        for btrfs_uuid in unlocks:
+            for future, path_luks_uuid in unlocks[btrfs_uuid]:
+                # raises CalledProcessError (with stderr) if cryptsetup failed
+                future.result()
+                print (f'    Successfully unlocked {path_luks_uuid}')
+
+            # newly unlocked drives may not be linked by udev yet
+            if btrfs_uuid not in disk_uuids:
+                if not wait_for_uuid(btrfs_uuid, UDEV_TIMEOUT):
+                    print (f'Warning: /dev/disk/by-uuid/{btrfs_uuid} did not appear', file=sys.stderr)
+
+            # mount the unlocked drives
+            cmd_list = [*MOUNT_CMD, btrfs_uuid, MOUNT_POINT]
+            subprocess.run(cmd_list, check=True,
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
             print (f'Successfully mounted {btrfs_uuid} to {MOUNT_POINT}')
-        else:
-            print (result, file=sys.stderr)
 
 
 def unmount():
-    if os.path.ismount(MOUNT_POINT):
-        mounted_uuid = get_filesystem_uuid(MOUNT_POINT)
-        if mounted_uuid in BTRFS_DRIVES_MAP:
-            # try to unmount
-            cmd = f'{UMOUNT} {MOUNT_POINT}'
-            cmd_list = shlex.split(cmd)
-            result = subprocess.run(cmd_list, check=True, capture_output=True, text=True)
-            if result.returncode == 0:
-                print (f'Successfully unmounted {MOUNT_POINT}')
-            else:
-                print (f'Error unmounting {MOUNT_POINT}')
-                print (result, file=sys.stderr)
-                sys.exit(1)
-        else:
-            print (f'ERROR: Unknown filesystem is mounted at {MOUNT_POINT}', file=sys.stderr)
-            sys.exit(1)
+    # we need the mounted btrfs uuid to know which drives to lock
+    if not os.path.ismount(MOUNT_POINT):
+        print (f'ERROR: Nothing is mounted at {MOUNT_POINT}', file=sys.stderr)
+        sys.exit(1)
+    mounted_uuid = get_filesystem_uuid(MOUNT_POINT)
+    if mounted_uuid not in BTRFS_DRIVES_MAP:
+        # also covers None, when the uuid could not be found
+        print (f'ERROR: Unknown filesystem is mounted at {MOUNT_POINT}', file=sys.stderr)
+        sys.exit(1)
+
+    # try to unmount
+    cmd_list = [UMOUNT, MOUNT_POINT]
+    subprocess.run(cmd_list, check=True,
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    print (f'Successfully unmounted {MOUNT_POINT}')
 
     error = False
-    for luks_uuid, dev_mapper in BTRFS_DRIVES_MAP[mounted_uuid]:
-        path_luks_uuid = f'/dev/disk/by-uuid/{luks_uuid}'
-        path_dev_mapper = f'/dev/mapper/{dev_mapper}'
-        if os.path.exists(path_dev_mapper):
+    dev_mappers = list_dir('/dev/mapper')
+    unlocked_drives = []
+    drives = DRIVES_BY_BTRFS[mounted_uuid]
+    for luks_uuid, dev_mapper, path_luks_uuid, path_dev_mapper in drives:
+        if dev_mapper in dev_mappers:
             # need to lock (close) this drive
             print (f'Found unlocked drive at {path_dev_mapper}')
-            cmd = f'{CRYPTSETUP} close {dev_mapper}'
-            cmd_list = shlex.split(cmd)
-            result = subprocess.run(cmd_list, check=True, capture_output=True, text=True)
-            if result.returncode == 0:
-                print (f'  Successfully locked {path_luks_uuid}')
-            else:
-                error = True
-                print (result, file=sys.stderr)
+            unlocked_drives.append((dev_mapper, path_luks_uuid))
+
+    # lock (close) the drives, each close is independent so run them at once
+    if unlocked_drives:
+        with ThreadPoolExecutor(max_workers=len(unlocked_drives)) as executor:
+            futures = {}
+            for dev_mapper, path_luks_uuid in unlocked_drives:
+                cmd_list = [CRYPTSETUP, 'close', dev_mapper]
+                future = executor.submit(subprocess.run, cmd_list, check=True,
+                    stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+                futures[future] = path_luks_uuid
+            for future in as_completed(futures):
+                path_luks_uuid = futures[future]
+                try:
+                    future.result()
+                except subprocess.CalledProcessError as e:
+                    error = True
+                    print (f'  Error locking {path_luks_uuid}', file=sys.stderr)
+                    if e.stderr: print (e.stderr, file=sys.stderr)
+                else:
+                    print (f'  Successfully locked {path_luks_uuid}')
 
     # try to rmdir the mountpoint
     try: